@@ -4,28 +4,188 @@ using an OpenAI model via lisette (lightweight wrapper over litellm).
 """
 
 import streamlit as st
-import pymupdf4llm
-from lisette import Chat
-import tempfile
 import os
-from dotenv import load_dotenv
-from config import SYSTEM_PROMPT_TEMPLATE, DEFAULT_MODEL, DEFAULT_TEMPERATURE, MAX_PAPER_CHARS, WARNING_PAPER_CHARS
-
-# Load environment variables from .env file
-load_dotenv()
+from config import (
+    MAX_PAPER_TOKENS,
+    WARNING_PAPER_TOKENS,
+    CHAT_HISTORY_WINDOW,
+    PREFETCH_FOLLOW_UPS,
+    FOLLOW_UP_POLL_SECONDS,
+)
+from paper import (
+    pdf_to_markdown,
+    count_tokens,
+    condense_paper,
+    compress_text,
+    decompress_text,
+    IncompleteCondenseError,
+)
+from tutor import (
+    create_prompt_cache_key,
+    create_chat,
+    reset_chat,
+    stream_response_text,
+    start_follow_ups,
+    get_follow_ups,
+    use_prefetched_answer,
+    cancel_follow_ups,
+)
 
 
-def create_system_prompt(paper_txt):
+@st.cache_data(show_spinner=False, max_entries=16)
+def condense_long_paper(paper_txt):
     """
-    Create the system prompt for the AI tutor.
+    Condense a paper over the token budget, caching the result per paper.
+    
+    Summarizing costs API calls, so it only happens once for a given paper.
+    Only complete results are cached: if some summaries fail, condense_paper
+    raises IncompleteCondenseError, and st.cache_data doesn't cache exceptions,
+    so the next upload of the paper tries again.
     
     Args:
         paper_txt: The extracted markdown text from the research paper
         
     Returns:
-        A formatted system prompt string
+        The condensed markdown text
     """
-    return SYSTEM_PROMPT_TEMPLATE.format(paper_txt=paper_txt)
+    return condense_paper(paper_txt)
+
+
+def get_paper_txt():
+    """
+    Get the uploaded paper's markdown text from session state.
+    
+    The paper is kept compressed in session state, so session state doesn't
+    hold a second plain copy next to the one in the Chat's paper message
+    (llm.hist[0]). Only call this where the text is actually needed.
+    
+    Returns:
+        The extracted markdown text
+    """
+    return decompress_text(st.session_state.paper_txt_z)
+
+
+@st.fragment
+def chat_panel():
+    """
+    Render the chat history and input, and answer the user's messages.
+    
+    Runs as a fragment: sending a message reruns only this panel instead of
+    the whole script. State is read from st.session_state on every run.
+    """
+    # Display chat history
+    # Only the most recent messages are rendered by default; older ones are
+    # only sent to the browser on request, so long conversations stay
+    # responsive on every rerun
+    messages = st.session_state.messages
+    older_count = max(len(messages) - CHAT_HISTORY_WINDOW, 0)
+    # Constant label and fixed key: before Streamlit 1.50 the widget identity
+    # includes the label, so a label with the count would be a new toggle (and
+    # switch back off) after every turn; the count is shown beside it instead
+    show_earlier = False
+    if older_count:
+        toggle_column, count_column = st.columns([3, 1])
+        with toggle_column:
+            show_earlier = st.toggle("Show earlier messages", key="show_earlier_messages")
+        with count_column:
+            st.caption(f"{older_count} earlier messages")
+    if show_earlier:
+        visible_messages = messages
+    else:
+        visible_messages = messages[older_count:]
+    
+    # Iterate through the visible messages and display them in a conversational format
+    for message in visible_messages:
+        # Use st.chat_message to create chat bubbles
+        # 'role' can be 'user' or 'assistant'
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+    
+    # A suggested follow-up question picked in follow_up_panel, if any
+    prompt = st.session_state.pending_prompt
+    st.session_state.pending_prompt = None
+    
+    # Chat input widget - allows user to type messages
+    if typed_prompt := st.chat_input("Ask a question about the paper..."):
+        prompt = typed_prompt
+    
+    if prompt:
+        # The suggestions belong to the previous reply; keep the picked one's
+        # prefetched answer and stop the rest
+        prefetched = get_follow_ups(st.session_state.follow_ups).pop(prompt, None)
+        cancel_follow_ups(st.session_state.follow_ups)
+        st.session_state.follow_ups = None
+        
+        # Add user message to chat history
+        st.session_state.messages.append({"role": "user", "content": prompt})
+        
+        # Display user message immediately
+        with st.chat_message("user"):
+            st.markdown(prompt)
+        
+        # Generate assistant response
+        with st.chat_message("assistant"):
+            # Create a placeholder for streaming response
+            message_placeholder = st.empty()
+            
+            response_text = ""
+            try:
+                if prefetched is not None:
+                    # Use the prefetched answer if it's ready, recording the exchange
+                    # in the LLM history; otherwise it's cancelled and we stream below
+                    response_text = use_prefetched_answer(st.session_state.llm, prompt, prefetched) or ""
+                if not response_text:
+                    # Send the user's message to the LLM and stream the response
+                    # Chat instance is callable - conversation history is automatically maintained
+                    for text in stream_response_text(
+                        st.session_state.llm, prompt, st.session_state.paper_hash
+                    ):
+                        response_text += text
+                        # Show the partial response with a cursor while tokens arrive
+                        message_placeholder.markdown(response_text + "▌")
+                
+                # Display the full response
+                message_placeholder.markdown(response_text)
+                
+                # Add assistant response to chat history
+                st.session_state.messages.append(
+                    {"role": "assistant", "content": response_text}
+                )
+                
+            except Exception as e:
+                # Handle errors during LLM call, keeping any partial response
+                error_msg = f"❌ Error generating response: {str(e)}"
+                if response_text:
+                    error_msg = f"{response_text}\n\n{error_msg}"
+                message_placeholder.markdown(error_msg)
+                st.session_state.messages.append(
+                    {"role": "assistant", "content": error_msg}
+                )
+                return
+        
+        if PREFETCH_FOLLOW_UPS:
+            # Suggest likely next questions and prefetch their answers in the
+            # background while the learner reads this reply; the turn doesn't
+            # wait on them, and follow_up_panel shows them once they're ready
+            st.session_state.follow_ups = start_follow_ups(
+                st.session_state.llm, st.session_state.paper_hash
+            )
+
+
+@st.fragment(run_every=FOLLOW_UP_POLL_SECONDS)
+def follow_up_panel():
+    """
+    Show the suggested follow-up questions as buttons once they are ready.
+    
+    Runs as a fragment that re-checks every FOLLOW_UP_POLL_SECONDS, so the
+    suggestions appear without waiting on them in the chat turn. Picking one
+    hands it to chat_panel as the next prompt.
+    """
+    for i, question in enumerate(get_follow_ups(st.session_state.follow_ups)):
+        if st.button(question, key=f"follow_up_{i}"):
+            st.session_state.pending_prompt = question
+            # Rerun the whole app so chat_panel picks up the question
+            st.rerun()
 
 # Configure the Streamlit page
 st.set_page_config(
@@ -48,12 +208,26 @@ if "messages" not in st.session_state:
     # Store chat history as list of dicts with 'role' and 'content' keys
     st.session_state.messages = []
 
-if "paper_txt" not in st.session_state:
-    # Store the extracted markdown text from the uploaded PDF
-    st.session_state.paper_txt = None
+if "paper_txt_z" not in st.session_state:
+    # Store the extracted markdown text from the uploaded PDF, compressed
+    # (read it back with get_paper_txt); the Chat history still holds one
+    # uncompressed copy for sending to the model
+    st.session_state.paper_txt_z = None
+
+if "paper_hash" not in st.session_state:
+    # Store the prompt cache key identifying the uploaded paper
+    st.session_state.paper_hash = None
+
+if "follow_ups" not in st.session_state:
+    # Store the Future of the suggested follow-up questions and their prefetched answers
+    st.session_state.follow_ups = None
+
+if "pending_prompt" not in st.session_state:
+    # Store a suggested follow-up question the learner picked, for chat_panel to send
+    st.session_state.pending_prompt = None
 
 if "llm" not in st.session_state:
-    # Store the Lisette LLM instance for conversation
+    # Store the Lisette AsyncChat instance for conversation
     st.session_state.llm = None
 
 # File uploader widget - accepts only PDF files
@@ -64,45 +238,48 @@ uploaded_file = st.file_uploader(
 )
 
 # Process the uploaded PDF
-if uploaded_file is not None and st.session_state.paper_txt is None:
+if uploaded_file is not None and st.session_state.paper_txt_z is None:
     # Show a spinner while processing the PDF
     with st.spinner("Processing PDF... This may take a moment."):
-        tmp_file_path = None
         try:
-            # Create a temporary file to save the uploaded PDF
-            # Note: delete=False means we must manually clean up the file
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-                # Write the uploaded file content to the temporary file
-                tmp_file.write(uploaded_file.getvalue())
-                tmp_file_path = tmp_file.name
+            # Convert PDF to markdown (cached on disk by file content)
+            # The progress bar advances as page ranges finish converting
+            progress_bar = st.progress(0.0)
+            paper_txt = pdf_to_markdown(uploaded_file.getvalue(), on_progress=progress_bar.progress)
+            progress_bar.empty()
             
-            # Convert PDF to markdown using pymupdf4llm
-            # This extracts text and structure from the PDF in markdown format
-            paper_txt = pymupdf4llm.to_markdown(tmp_file_path)
+            # Condense the paper if it doesn't fit the token budget
+            paper_tokens = count_tokens(paper_txt)
+            if paper_tokens > MAX_PAPER_TOKENS:
+                st.info(f"📝 Paper is long ({paper_tokens:,} tokens). Summarizing some sections so it fits...")
+                try:
+                    paper_txt = condense_long_paper(paper_txt)
+                    paper_tokens = count_tokens(paper_txt)
+                except IncompleteCondenseError as e:
+                    # Use what was summarized this time; it may still fit
+                    st.warning(f"⚠️ Some sections couldn't be summarized ({e.failed}) and are kept in full.")
+                    paper_txt = e.paper_txt
+                    paper_tokens = count_tokens(paper_txt)
+                except Exception as e:
+                    # The PDF itself is fine - report the summarizing failure on its own
+                    # (the paper then stays over budget and is rejected below)
+                    st.error(f"❌ Error summarizing the paper to fit: {str(e)}")
             
             # Check paper size and warn if too large
-            paper_length = len(paper_txt)
-            if paper_length > MAX_PAPER_CHARS:
-                st.error(f"❌ Paper is too large ({paper_length:,} characters). Maximum supported size is {MAX_PAPER_CHARS:,} characters.")
+            if paper_tokens > MAX_PAPER_TOKENS:
+                st.error(f"❌ Paper is too large ({paper_tokens:,} tokens). Maximum supported size is {MAX_PAPER_TOKENS:,} tokens.")
                 st.error("Please upload a shorter paper or consider splitting it into sections.")
-            elif paper_length > WARNING_PAPER_CHARS:
-                st.warning(f"⚠️ Paper is quite large ({paper_length:,} characters). This may result in higher API costs and slower responses.")
+            elif paper_tokens > WARNING_PAPER_TOKENS:
+                st.warning(f"⚠️ Paper is quite large ({paper_tokens:,} tokens). This may result in higher API costs and slower responses.")
             
             # Only proceed if paper is not too large
-            if paper_length <= MAX_PAPER_CHARS:
-                # Create the system prompt that defines the AI tutor's behavior
-                system_prompt = create_system_prompt(paper_txt)
+            if paper_tokens <= MAX_PAPER_TOKENS:
+                # Initialize the LLM using lisette AsyncChat, starting from the paper
+                llm = create_chat(paper_txt)
                 
-                # Initialize the LLM using lisette Chat
-                # Chat is a lightweight wrapper over litellm for easy conversation management
-                llm = Chat(
-                    model=DEFAULT_MODEL,  # Use model from config
-                    sp=system_prompt,  # Set the system prompt using 'sp' parameter
-                    temp=DEFAULT_TEMPERATURE,  # Temperature from config
-                )
-                
-                # Only store paper_txt and llm in session state after successful initialization
-                st.session_state.paper_txt = paper_txt
+                # Only store the paper and llm in session state after successful initialization
+                st.session_state.paper_txt_z = compress_text(paper_txt)
+                st.session_state.paper_hash = create_prompt_cache_key(paper_txt)
                 st.session_state.llm = llm
                 
                 # Show success message
@@ -113,31 +290,19 @@ if uploaded_file is not None and st.session_state.paper_txt is None:
             st.error(f"❌ Error processing PDF: {str(e)}")
             st.error("Please make sure you uploaded a valid PDF file.")
             # Reset session state on error
-            st.session_state.paper_txt = None
+            st.session_state.paper_txt_z = None
+            st.session_state.paper_hash = None
             st.session_state.llm = None
-        finally:
-            # Always clean up the temporary file
-            if tmp_file_path and os.path.exists(tmp_file_path):
-                try:
-                    os.unlink(tmp_file_path)
-                except Exception as cleanup_error:
-                    # Log cleanup error but don't fail the whole process
-                    st.warning(f"⚠️ Could not clean up temporary file: {cleanup_error}")
 
 # Show chat interface only if paper has been processed AND LLM is initialized
-if st.session_state.paper_txt is not None:
+if st.session_state.paper_txt_z is not None:
     
     # Check if LLM is missing but paper exists (initialization failure scenario)
     if st.session_state.llm is None:
         st.error("⚠️ The AI tutor failed to initialize. Please try reinitializing.")
         if st.button("🔄 Reinitialize AI Tutor"):
             try:
-                system_prompt = create_system_prompt(st.session_state.paper_txt)
-                st.session_state.llm = Chat(
-                    model=DEFAULT_MODEL,
-                    sp=system_prompt,
-                    temp=DEFAULT_TEMPERATURE,
-                )
+                st.session_state.llm = create_chat(get_paper_txt())
                 st.success("✅ AI tutor reinitialized successfully!")
                 st.rerun()
             except Exception as e:
@@ -149,62 +314,20 @@ if st.session_state.paper_txt is not None:
         if st.sidebar.button("🗑️ Clear Chat", use_container_width=True):
             # Reset chat history
             st.session_state.messages = []
-            # Reinitialize the LLM to start fresh conversation
-            # This clears the conversation history in the LLM
-            system_prompt = create_system_prompt(st.session_state.paper_txt)
-            st.session_state.llm = Chat(
-                model=DEFAULT_MODEL,
-                sp=system_prompt,
-                temp=DEFAULT_TEMPERATURE,
-            )
+            # Drop suggestions for the old conversation
+            cancel_follow_ups(st.session_state.follow_ups)
+            st.session_state.follow_ups = None
+            # Clear the conversation history kept by the LLM, keeping the paper
+            # The Chat instance is reused as is
+            reset_chat(st.session_state.llm, get_paper_txt())
             st.rerun()  # Rerun the app to reflect the cleared state
         
-        # Display chat history
-        # Iterate through all messages and display them in a conversational format
-        for message in st.session_state.messages:
-            # Use st.chat_message to create chat bubbles
-            # 'role' can be 'user' or 'assistant'
-            with st.chat_message(message["role"]):
-                st.markdown(message["content"])
+        # Show the chat panel (history, input and replies)
+        chat_panel()
         
-        # Chat input widget - allows user to type messages
-        if prompt := st.chat_input("Ask a question about the paper..."):
-            # Add user message to chat history
-            st.session_state.messages.append({"role": "user", "content": prompt})
-            
-            # Display user message immediately
-            with st.chat_message("user"):
-                st.markdown(prompt)
-            
-            # Generate assistant response
-            with st.chat_message("assistant"):
-                # Create a placeholder for streaming response
-                message_placeholder = st.empty()
-                
-                try:
-                    # Send the user's message to the LLM and get response
-                    # Chat instance is callable - conversation history is automatically maintained
-                    response = st.session_state.llm(prompt)
-                    
-                    # Extract the message content from the response
-                    # response is a ModelResponse object, we need to get the actual text content
-                    response_text = response.choices[0].message.content
-                    
-                    # Display the full response
-                    message_placeholder.markdown(response_text)
-                    
-                    # Add assistant response to chat history
-                    st.session_state.messages.append(
-                        {"role": "assistant", "content": response_text}
-                    )
-                    
-                except Exception as e:
-                    # Handle errors during LLM call
-                    error_msg = f"❌ Error generating response: {str(e)}"
-                    message_placeholder.markdown(error_msg)
-                    st.session_state.messages.append(
-                        {"role": "assistant", "content": error_msg}
-                    )
+        if PREFETCH_FOLLOW_UPS:
+            # Show suggested follow-up questions once they are ready
+            follow_up_panel()
 
 else:
     # Show instructions when no paper is uploaded
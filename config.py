@@ -1,13 +1,22 @@
 """
 Configuration file for the Research Paper Tutor application.
-Contains the system prompt template and other configuration settings.
+Contains the system prompt, paper message template and other configuration settings.
 """
 
-SYSTEM_PROMPT_TEMPLATE = """
-You are helping someone understand an academic paper.
-Here is the paper \n
+from dotenv import load_dotenv
 
-{paper_txt}
+# Load environment variables from .env file
+# Done here rather than in app.py: this module is imported once per server
+# process, while app.py is re-executed on every Streamlit rerun
+load_dotenv()
+
+# The system prompt only holds the teaching rules. The paper is sent as the first
+# user message (PAPER_MESSAGE_TEMPLATE), followed by a fixed acknowledgement, so
+# every request starts with the same rules + paper prefix that OpenAI's automatic
+# prompt caching reuses on every turn. Keep anything that varies out of both.
+SYSTEM_PROMPT = """
+You are helping someone understand an academic paper.
+The paper is given in the first user message.
 
 CRITICAL RULES:
 1. NEVER explain everything at once. Take ONE small step, then STOP and wait.
@@ -26,10 +35,72 @@ BAD (don't do this):
 "Here's everything about DPPs: [wall of text with all equations]"
 """
 
+PAPER_MESSAGE_TEMPLATE = """
+Here is the paper:
+
+<paper>
+{paper_txt}
+</paper>
+"""
+
+PAPER_ACKNOWLEDGEMENT = "Got it. I've read the paper and I'm ready to help you understand it."
+
 # LLM Configuration
 DEFAULT_MODEL = "gpt-4o-mini"
 DEFAULT_TEMPERATURE = 0.4
 
-# Paper processing limits
-MAX_PAPER_CHARS = 100000  # Approximately 25k tokens for GPT-4o-mini
-WARNING_PAPER_CHARS = 80000  # Show warning above this threshold
+# Shared HTTP client for async LLM requests (one per server process)
+HTTP_TIMEOUT = 60.0  # Seconds to wait on reads/writes, e.g. between streamed chunks
+HTTP_CONNECT_TIMEOUT = 5.0  # Seconds to establish a connection
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 64
+HTTP_MAX_CONNECTIONS = 128
+
+# Chat display
+CHAT_HISTORY_WINDOW = 20  # Most recent messages shown; older ones are hidden behind a toggle
+
+# Follow-up suggestions: after each reply, suggest likely next questions and
+# prefetch their answers in the background so picking one answers instantly.
+# Off by default: each turn then makes FOLLOW_UP_COUNT + 1 extra requests, and
+# every one resends the whole conversation including the paper (mostly billed at
+# the prompt-cache discount)
+PREFETCH_FOLLOW_UPS = False
+FOLLOW_UP_COUNT = 3
+FOLLOW_UP_TEMPERATURE = 0.2
+FOLLOW_UP_MAX_TOKENS = 500  # Cap on each suggestion/answer; cut-off answers are asked again
+FOLLOW_UP_POLL_SECONDS = 1  # How often the suggestion buttons check for finished suggestions
+
+FOLLOW_UP_PROMPT_TEMPLATE = """
+Suggest {count} short questions the learner is most likely to ask you next about the paper,
+given our conversation so far. Write them in the learner's voice, one per line,
+with no numbering and no other text.
+"""
+
+# Paper processing limits (in tokens, counted with tiktoken)
+TOKEN_ENCODING = "o200k_base"  # Tokenizer used by the GPT-4o model family
+MAX_PAPER_TOKENS = 100000  # GPT-4o-mini has a 128k context; leave room for the conversation
+WARNING_PAPER_TOKENS = 60000  # Show warning above this threshold
+# Long papers are converted in parallel processes. Each worker is a fresh interpreter
+# that re-imports PyMuPDF and gets its own copy of the PDF, so workers are capped and
+# each gets enough pages to pay for its startup (parallel from 2x this many pages)
+MAX_PDF_WORKERS = 4  # Worker processes per conversion
+MIN_PAGES_PER_PDF_WORKER = 16  # Pages each worker converts at least
+FAST_PARSE_PAGE_THRESHOLD = 20  # Use FAST_PARSE_OPTIONS for papers with more pages than this
+# Faster pymupdf4llm settings for long papers: skip image analysis (the tutor only
+# reads text) and don't analyze pages with huge numbers of vector graphics, e.g.
+# dense plots, which dominate parse time
+FAST_PARSE_OPTIONS = {"ignore_images": True, "graphics_limit": 5000}
+PAPER_CACHE_DIR = "~/.cache/paperbuddy"  # On-disk cache of converted papers
+PAPER_CACHE_SIZE_LIMIT = 2 ** 30  # 1 GiB; least recently used papers are evicted beyond this
+
+# Papers over MAX_PAPER_TOKENS are condensed: sections whose heading matches this
+# pattern (plus the title/abstract block before the first heading) are kept
+# verbatim, and every other section is summarized
+KEEP_SECTIONS_PATTERN = r"abstract|introduction|conclusion"
+SUMMARY_CONCURRENCY = 4  # Section summaries requested at once
+
+SECTION_SUMMARY_PROMPT_TEMPLATE = """
+Summarize the following section of an academic paper in a few dense paragraphs.
+Keep the key definitions, equations, results and numbers. Do not add commentary.
+
+{section}
+"""
@@ -0,0 +1,407 @@
+"""
+Paper processing helpers for the Research Paper Tutor application.
+Converts uploaded PDFs to markdown, spreading long papers across processes
+and keeping the results in an on-disk cache, and condenses papers that don't
+fit the token budget.
+
+Kept separate from app.py so the worker function can be pickled and
+imported by the process pool without pulling in Streamlit. Heavy
+dependencies (PyMuPDF, tiktoken, diskcache, and litellm via tutor) are
+imported inside the functions that use them, so the app's first screen renders without
+loading them.
+"""
+
+import asyncio
+import functools
+import hashlib
+import multiprocessing
+import os
+import re
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from config import (
+    DEFAULT_MODEL,
+    FAST_PARSE_OPTIONS,
+    FAST_PARSE_PAGE_THRESHOLD,
+    KEEP_SECTIONS_PATTERN,
+    MAX_PDF_WORKERS,
+    MIN_PAGES_PER_PDF_WORKER,
+    PAPER_CACHE_DIR,
+    PAPER_CACHE_SIZE_LIMIT,
+    SECTION_SUMMARY_PROMPT_TEMPLATE,
+    SUMMARY_CONCURRENCY,
+    TOKEN_ENCODING,
+)
+
+
+class IncompleteCondenseError(Exception):
+    """
+    Raised by condense_paper when some section summaries failed.
+    
+    Attributes:
+        paper_txt: The condensed markdown, with the failed sections kept as is
+        failed: Number of sections whose summary failed
+    """
+    
+    def __init__(self, paper_txt, failed):
+        super().__init__(f"{failed} section summaries failed")
+        self.paper_txt = paper_txt
+        self.failed = failed
+
+
+def split_pages(page_count, n_chunks):
+    """
+    Split page indices into contiguous, evenly sized chunks.
+    
+    Args:
+        page_count: Number of pages in the document
+        n_chunks: Number of chunks to produce
+        
+    Returns:
+        A list of page index lists, in document order
+    """
+    size, extra = divmod(page_count, n_chunks)
+    chunks = []
+    start = 0
+    for i in range(n_chunks):
+        end = start + size + (1 if i < extra else 0)
+        chunks.append(list(range(start, end)))
+        start = end
+    return chunks
+
+
+def get_parse_options(page_count):
+    """
+    Choose the pymupdf4llm options for a document.
+    
+    Papers with more than FAST_PARSE_PAGE_THRESHOLD pages use the faster,
+    text-focused FAST_PARSE_OPTIONS.
+    
+    Args:
+        page_count: Number of pages in the document
+        
+    Returns:
+        A dict of keyword arguments for pymupdf4llm.to_markdown
+    """
+    if page_count > FAST_PARSE_PAGE_THRESHOLD:
+        return dict(FAST_PARSE_OPTIONS)
+    return {}
+
+
+def pages_to_markdown(pdf_bytes, pages, options):
+    """
+    Convert a subset of a PDF's pages to markdown (process pool worker).
+    
+    Args:
+        pdf_bytes: The raw bytes of the PDF
+        pages: The page indices to convert
+        options: Keyword arguments for pymupdf4llm.to_markdown
+        
+    Returns:
+        The markdown text for those pages
+    """
+    import pymupdf
+    import pymupdf4llm
+    
+    # Each worker opens its own Document - they can't be shared across processes
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+        return pymupdf4llm.to_markdown(doc, pages=pages, **options)
+
+
+def compress_text(text):
+    """
+    Compress text for storage (markdown typically shrinks several-fold).
+    
+    Args:
+        text: The text to compress
+        
+    Returns:
+        The zlib-compressed UTF-8 bytes
+    """
+    return zlib.compress(text.encode())
+
+
+def decompress_text(data):
+    """
+    Restore text stored with compress_text.
+    
+    Args:
+        data: The compressed bytes
+        
+    Returns:
+        The original text
+    """
+    return zlib.decompress(data).decode()
+
+
+@functools.lru_cache(maxsize=1)
+def get_paper_cache():
+    """
+    Get the on-disk cache of converted papers.
+    
+    Created on first use, so process pool workers never open it.
+    
+    Returns:
+        A diskcache.Cache evicting least recently used papers
+    """
+    import diskcache
+    
+    return diskcache.Cache(
+        os.path.expanduser(PAPER_CACHE_DIR),
+        size_limit=PAPER_CACHE_SIZE_LIMIT,
+        eviction_policy="least-recently-used",
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def get_parser_version():
+    """
+    Identify the parser and settings that produce a paper's markdown.
+    
+    Read from package metadata, so pymupdf4llm isn't imported on a cache hit.
+    
+    Returns:
+        A short string that changes with the pymupdf4llm version or parse settings
+    """
+    from importlib.metadata import version
+    
+    # The page ranges (set by the worker settings) affect header levels too
+    settings = repr((
+        sorted(FAST_PARSE_OPTIONS.items()),
+        FAST_PARSE_PAGE_THRESHOLD,
+        MAX_PDF_WORKERS,
+        MIN_PAGES_PER_PDF_WORKER,
+    ))
+    settings_hash = hashlib.blake2b(settings.encode(), digest_size=8).hexdigest()
+    return f"pymupdf4llm-{version('pymupdf4llm')}-{settings_hash}"
+
+
+def pdf_to_markdown(pdf_bytes, on_progress=None):
+    """
+    Convert a PDF to markdown, reusing earlier conversions from disk.
+    
+    The markdown is stored zlib-compressed, keyed by a hash of the PDF bytes,
+    so a known paper is a quick disk read even after a server restart. Keys
+    are prefixed with get_parser_version, so upgrading pymupdf4llm or changing
+    the parse settings converts papers again instead of serving stale text. The
+    cache is only an optimisation: if it can't be used (e.g. a read-only or
+    full disk), the PDF is parsed without it.
+    
+    Args:
+        pdf_bytes: The raw bytes of the PDF
+        on_progress: Optional callback receiving the fraction of pages converted
+        
+    Returns:
+        The extracted markdown text
+    """
+    try:
+        key = f"{get_parser_version()}:{hashlib.blake2b(pdf_bytes, digest_size=32).hexdigest()}"
+        cache = get_paper_cache()
+        compressed = cache.get(key)
+        if compressed is not None:
+            return decompress_text(compressed)
+    except Exception:
+        cache = None
+    
+    paper_txt = parse_pdf(pdf_bytes, on_progress)
+    if cache is not None:
+        try:
+            cache.set(key, compress_text(paper_txt))
+        except Exception:
+            # Not cached this time; the conversion itself succeeded
+            pass
+    return paper_txt
+
+
+def parse_pdf(pdf_bytes, on_progress=None):
+    """
+    Convert a PDF to markdown.
+    
+    Papers long enough to give each of two or more workers
+    MIN_PAGES_PER_PDF_WORKER pages are split into page ranges that are
+    converted in parallel worker processes (at most MAX_PDF_WORKERS), and long
+    papers use the fast parse options (see get_parse_options).
+    
+    Each range is converted on its own, so pymupdf4llm picks header levels from
+    that range's font sizes; a heading may get a different level than it would
+    in a single pass over the whole paper.
+    
+    Args:
+        pdf_bytes: The raw bytes of the PDF
+        on_progress: Optional callback receiving the fraction of pages converted,
+            called as each page range finishes
+        
+    Returns:
+        The extracted markdown text
+    """
+    import pymupdf
+    import pymupdf4llm
+    
+    # Open the PDF straight from memory - no temporary file needed
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+        page_count = doc.page_count
+        options = get_parse_options(page_count)
+        n_workers = min(
+            os.cpu_count() or 1,
+            MAX_PDF_WORKERS,
+            page_count // MIN_PAGES_PER_PDF_WORKER,
+        )
+        if n_workers < 2:
+            # Short paper (or single core): process pool startup isn't worth it
+            paper_txt = pymupdf4llm.to_markdown(doc, **options)
+            if on_progress:
+                on_progress(1.0)
+            return paper_txt
+    
+    chunks = split_pages(page_count, n_workers)
+    results = [None] * len(chunks)
+    pages_done = 0
+    # Spawn rather than fork: this runs in a thread of the multi-threaded
+    # Streamlit server, and forking a multi-threaded process can deadlock
+    spawn_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=spawn_context) as executor:
+        futures = {
+            executor.submit(pages_to_markdown, pdf_bytes, chunk, options): i
+            for i, chunk in enumerate(chunks)
+        }
+        # Collect ranges as they finish, reporting progress; store each result
+        # at its index so pages stay in order
+        for future in as_completed(futures):
+            i = futures[future]
+            results[i] = future.result()
+            pages_done += len(chunks[i])
+            if on_progress:
+                on_progress(pages_done / page_count)
+    return "".join(results)
+
+
+def count_tokens(text):
+    """
+    Count the tokens in a text the way the model will see them.
+    
+    Args:
+        text: The text to count
+        
+    Returns:
+        The number of tokens
+    """
+    import tiktoken
+    
+    # get_encoding caches the encoder, so repeated calls are cheap
+    encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+    # Papers may contain strings like "<|endoftext|>" - count them as plain text
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def split_sections(paper_txt):
+    """
+    Split paper markdown into sections at its headings.
+    
+    Args:
+        paper_txt: The paper markdown
+        
+    Returns:
+        A list of sections, each starting with its heading line (except the
+        first one, which holds any text before the first heading)
+    """
+    sections = []
+    current = []
+    fence = None  # The ``` or ~~~ marker of the fenced code block we're in
+    for line in paper_txt.splitlines(keepends=True):
+        stripped = line.lstrip()
+        if fence is None and stripped.startswith(("```", "~~~")):
+            fence = stripped[:3]
+        elif fence is not None and stripped.startswith(fence):
+            fence = None
+        elif fence is None and re.match(r"#+ ", line):
+            # Split before each heading so headings stay with their section;
+            # "#" lines inside code blocks are comments, not headings
+            sections.append("".join(current))
+            current = []
+        current.append(line)
+    sections.append("".join(current))
+    return sections
+
+
+async def summarize_sections(sections):
+    """
+    Summarize paper sections concurrently with the LLM.
+    
+    At most SUMMARY_CONCURRENCY requests run at once, so papers with many
+    sections don't trip the API's rate limits.
+    
+    Args:
+        sections: The section texts to summarize
+        
+    Returns:
+        The summaries, in the same order as sections; None for any section
+        whose summary failed
+    """
+    from tutor import get_litellm
+    
+    litellm = get_litellm()
+    semaphore = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+    
+    async def summarize(section):
+        async with semaphore:
+            try:
+                response = await litellm.acompletion(
+                    model=DEFAULT_MODEL,
+                    messages=[{
+                        "role": "user",
+                        "content": SECTION_SUMMARY_PROMPT_TEMPLATE.format(section=section),
+                    }],
+                    temperature=0,
+                )
+            except Exception:
+                # One failed section (e.g. rate limited) shouldn't fail the paper
+                return None
+            return response.choices[0].message.content
+    
+    return await asyncio.gather(*(summarize(section) for section in sections))
+
+
+def condense_paper(paper_txt):
+    """
+    Shrink a paper that is over the token budget.
+    
+    The text before the first heading (title, authors, abstract) and the
+    sections matching KEEP_SECTIONS_PATTERN are kept verbatim; all other
+    sections are replaced by LLM summaries made in parallel.
+    
+    Args:
+        paper_txt: The paper markdown
+        
+    Returns:
+        The condensed paper markdown
+        
+    Raises:
+        IncompleteCondenseError: If any summary failed. The failed sections are
+            kept as is in its paper_txt, which may still be over budget; it is
+            raised rather than returned so callers don't cache it
+    """
+    sections = split_sections(paper_txt)
+    keep_pattern = re.compile(KEEP_SECTIONS_PATTERN, re.IGNORECASE)
+    
+    # Indices of the sections to summarize - the first "section" is the preamble
+    to_summarize = [
+        i for i, section in enumerate(sections)
+        if i > 0 and not keep_pattern.search(section.split("\n", 1)[0])
+    ]
+    if not to_summarize:
+        return paper_txt
+    
+    # Run on the tutor's shared event loop, which owns the shared HTTP client
+    from tutor import run_on_event_loop
+    
+    summaries = run_on_event_loop(summarize_sections([sections[i] for i in to_summarize]))
+    failed = 0
+    for i, summary in zip(to_summarize, summaries):
+        if summary is None:
+            failed += 1
+            continue
+        heading = sections[i].split("\n", 1)[0]
+        sections[i] = f"{heading}\n\n_(Section summarized to fit the paper into context.)_\n\n{summary}\n\n"
+    if failed:
+        raise IncompleteCondenseError("".join(sections), failed)
+    return "".join(sections)
@@ -0,0 +1,399 @@
+"""
+Tutor helpers for the Research Paper Tutor application.
+Builds the lisette Chat seeded with the paper, streams its replies, and
+prefetches answers to likely follow-up questions.
+"""
+
+import asyncio
+import functools
+import hashlib
+import queue
+import threading
+import re
+from config import (
+    SYSTEM_PROMPT,
+    PAPER_MESSAGE_TEMPLATE,
+    PAPER_ACKNOWLEDGEMENT,
+    DEFAULT_MODEL,
+    DEFAULT_TEMPERATURE,
+    FOLLOW_UP_COUNT,
+    FOLLOW_UP_PROMPT_TEMPLATE,
+    FOLLOW_UP_TEMPERATURE,
+    FOLLOW_UP_MAX_TOKENS,
+    HTTP_TIMEOUT,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    HTTP_MAX_CONNECTIONS,
+)
+
+# One event loop on a background thread for the whole server process. Replies
+# are streamed on it, so network reads keep going while the Streamlit script
+# thread renders the text received so far. Every async LLM call (follow-up
+# prefetches, section summaries) runs on it too, which lets them all share the
+# HTTP client set up by get_litellm.
+_loop = asyncio.new_event_loop()
+threading.Thread(target=_loop.run_forever, name="llm-event-loop", daemon=True).start()
+
+# Marks the end of a streamed reply in the queue
+_END_OF_STREAM = object()
+
+
+@functools.cache
+def get_litellm():
+    """
+    Import litellm and configure it once per server process.
+    
+    Async requests share one HTTP/2 client with a keep-alive pool, so new
+    chats reuse open connections to the API instead of a new TLS handshake.
+    
+    Returns:
+        The configured litellm module
+    """
+    import httpx
+    import litellm
+    
+    # Connections belong to the event loop that opened them; all async calls
+    # run on _loop (see run_on_event_loop), so one client is safe to share
+    timeout = httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+    litellm.aclient_session = httpx.AsyncClient(
+        http2=True,
+        timeout=timeout,
+        limits=httpx.Limits(
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            max_connections=HTTP_MAX_CONNECTIONS,
+        ),
+    )
+    # litellm passes its own timeout (default 6000 s) to the OpenAI client on
+    # every request, overriding the client's; give it the same overall timeout.
+    # It must be a number: litellm calls float() on it for every request
+    litellm.request_timeout = HTTP_TIMEOUT
+    # Drop parameters the model doesn't support instead of failing the request
+    litellm.drop_params = True
+    return litellm
+
+
+def run_on_event_loop(coro):
+    """
+    Run a coroutine on the shared event loop and wait for its result.
+    
+    Args:
+        coro: The coroutine to run
+        
+    Returns:
+        The coroutine's result
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _loop).result()
+
+
+def create_paper_message(paper_txt):
+    """
+    Create the user message that gives the paper to the AI tutor.
+    
+    Args:
+        paper_txt: The extracted markdown text from the research paper
+        
+    Returns:
+        A formatted message string
+    """
+    # Not memoized: callers pass a freshly decompressed paper, so a cache lookup
+    # would hash and compare the whole text (costing as much as formatting it)
+    # and keep plain copies of papers alive for the whole server process. This
+    # only runs when a chat is created or cleared, not on every rerun
+    return PAPER_MESSAGE_TEMPLATE.format(paper_txt=paper_txt)
+
+
+def create_paper_history(paper_txt):
+    """
+    Create the conversation history a new chat starts from.
+    
+    Args:
+        paper_txt: The extracted markdown text from the research paper
+        
+    Returns:
+        A new list with the paper message and the tutor's acknowledgement
+    """
+    return [
+        {"role": "user", "content": create_paper_message(paper_txt)},
+        {"role": "assistant", "content": PAPER_ACKNOWLEDGEMENT},
+    ]
+
+
+def create_prompt_cache_key(paper_txt):
+    """
+    Create a stable key identifying the paper for OpenAI prompt caching.
+    
+    Args:
+        paper_txt: The extracted markdown text from the research paper
+        
+    Returns:
+        A short hex digest of the paper text
+    """
+    return hashlib.sha256(paper_txt.encode()).hexdigest()[:32]
+
+
+def create_chat(paper_txt):
+    """
+    Create the lisette AsyncChat instance used for the conversation.
+    
+    Args:
+        paper_txt: The extracted markdown text from the research paper
+        
+    Returns:
+        An AsyncChat instance configured with the default model and temperature,
+        whose history starts with the paper
+    """
+    # Imported on first use: lisette pulls in litellm and its provider registry,
+    # which the upload screen doesn't need
+    get_litellm()
+    from lisette import AsyncChat
+    
+    # AsyncChat is a lightweight wrapper over litellm for easy conversation management
+    return AsyncChat(
+        model=DEFAULT_MODEL,  # Use model from config
+        sp=SYSTEM_PROMPT,  # Set the system prompt using 'sp' parameter
+        temp=DEFAULT_TEMPERATURE,  # Temperature from config
+        hist=create_paper_history(paper_txt),  # Seed the history with the paper
+    )
+
+
+def reset_chat(llm, paper_txt):
+    """
+    Clear a Chat's conversation, keeping only the paper at its start.
+    
+    Args:
+        llm: The lisette AsyncChat instance to reset
+        paper_txt: The extracted markdown text from the research paper
+    """
+    llm.hist[:] = create_paper_history(paper_txt)
+
+
+def _cache_kwargs(prompt_cache_key):
+    """
+    Build the litellm arguments that pin a request to the paper's prompt cache.
+    
+    Args:
+        prompt_cache_key: Key identifying the paper, or None
+        
+    Returns:
+        A dict of keyword arguments for litellm (empty without a key)
+    """
+    if not prompt_cache_key:
+        return {}
+    return {"extra_body": {"prompt_cache_key": prompt_cache_key}}
+
+
+async def _put_response_text(llm, prompt, text_queue, kwargs):
+    """
+    Stream the reply on the event loop, putting text deltas on a queue.
+    
+    Args:
+        llm: The lisette AsyncChat instance holding the conversation
+        prompt: The user's message
+        text_queue: Queue receiving the deltas, then _END_OF_STREAM
+        kwargs: Extra arguments passed on to litellm
+    """
+    try:
+        # With stream=True lisette yields the streamed chunks followed by the
+        # complete ModelResponse; only the chunks carry a delta
+        async for chunk in await llm(prompt, stream=True, **kwargs):
+            delta = getattr(chunk.choices[0], "delta", None)
+            if delta is not None and delta.content:
+                text_queue.put(delta.content)
+    finally:
+        text_queue.put(_END_OF_STREAM)
+
+
+def stream_response_text(llm, prompt, prompt_cache_key=None):
+    """
+    Stream the assistant's reply as text deltas.
+    
+    Args:
+        llm: The lisette AsyncChat instance holding the conversation
+        prompt: The user's message
+        prompt_cache_key: Optional key routing requests for the same paper to
+            the same OpenAI cache, so the paper prefix gets cache hits
+        
+    Yields:
+        Pieces of the response text as they arrive from the model
+    """
+    text_queue = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(
+        _put_response_text(llm, prompt, text_queue, _cache_kwargs(prompt_cache_key)), _loop
+    )
+    try:
+        while (text := text_queue.get()) is not _END_OF_STREAM:
+            yield text
+        # Re-raise any error from the stream in the caller's thread
+        future.result()
+    finally:
+        # Stop the request if the caller stops reading (e.g. Streamlit rerun)
+        future.cancel()
+
+
+def _chat_messages(llm):
+    """
+    Snapshot the messages the Chat would send before the next prompt.
+    
+    Args:
+        llm: The lisette AsyncChat instance holding the conversation
+        
+    Returns:
+        A new list of message dicts: system prompt, then the history
+    """
+    # History holds plain dicts and litellm Message objects from earlier replies
+    history = [
+        message if isinstance(message, dict)
+        else {"role": message.role, "content": message.content}
+        for message in llm.hist
+    ]
+    return [{"role": "system", "content": llm.sp}, *history]
+
+
+async def _complete_text(messages, temperature, max_tokens, kwargs):
+    """
+    Get a complete (non-streamed) reply from the model.
+    
+    Args:
+        messages: The messages to send
+        temperature: Sampling temperature
+        max_tokens: Upper bound on the reply length
+        kwargs: Extra arguments passed on to litellm
+        
+    Returns:
+        The reply text
+        
+    Raises:
+        ValueError: If the reply was cut off at max_tokens
+    """
+    litellm = get_litellm()
+    
+    response = await litellm.acompletion(
+        model=DEFAULT_MODEL,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        **kwargs,
+    )
+    choice = response.choices[0]
+    if choice.finish_reason == "length":
+        # A truncated answer is worse than asking again with streaming
+        raise ValueError("Reply was cut off at max_tokens")
+    return choice.message.content or ""
+
+
+async def _suggest_and_prefetch(messages, kwargs):
+    """
+    Suggest follow-up questions, then start prefetching their answers.
+    
+    Runs on the shared event loop. Returns as soon as the questions are
+    known; the answers keep loading in the background.
+    
+    Args:
+        messages: Snapshot of the conversation from _chat_messages
+        kwargs: Extra arguments passed on to litellm
+        
+    Returns:
+        A dict mapping each question to a concurrent.futures.Future of its answer
+    """
+    text = await _complete_text(
+        [*messages, {"role": "user", "content": FOLLOW_UP_PROMPT_TEMPLATE.format(count=FOLLOW_UP_COUNT)}],
+        FOLLOW_UP_TEMPERATURE,
+        FOLLOW_UP_MAX_TOKENS,
+        kwargs,
+    )
+    # One question per line; drop any bullets or numbering the model adds anyway
+    questions = [re.sub(r"^\s*(?:[-*•]|\d+[.)])\s*", "", line).strip() for line in text.splitlines()]
+    questions = [question for question in questions if question][:FOLLOW_UP_COUNT]
+    # Thread-safe futures, so the script thread can check and cancel them
+    return {
+        question: asyncio.run_coroutine_threadsafe(
+            _complete_text(
+                [*messages, {"role": "user", "content": question}],
+                DEFAULT_TEMPERATURE,
+                FOLLOW_UP_MAX_TOKENS,
+                kwargs,
+            ),
+            _loop,
+        )
+        for question in questions
+    }
+
+
+def start_follow_ups(llm, prompt_cache_key=None):
+    """
+    Start suggesting follow-up questions and prefetching their answers.
+    
+    Nothing waits on the requests: they run on the shared event loop while
+    the learner reads the last reply.
+    
+    Args:
+        llm: The lisette AsyncChat instance holding the conversation
+        prompt_cache_key: Optional key routing the requests to the paper's cache
+        
+    Returns:
+        A concurrent.futures.Future of the dict described in _suggest_and_prefetch
+    """
+    # Snapshot the history now - the Chat keeps changing after this returns
+    return asyncio.run_coroutine_threadsafe(
+        _suggest_and_prefetch(_chat_messages(llm), _cache_kwargs(prompt_cache_key)), _loop
+    )
+
+
+def get_follow_ups(follow_ups):
+    """
+    Get the suggested questions if they are ready, without waiting.
+    
+    Args:
+        follow_ups: The Future from start_follow_ups, or None
+        
+    Returns:
+        A dict mapping questions to Futures of their answers; empty while the
+        suggestions are still loading or if they failed
+    """
+    if follow_ups is None or not follow_ups.done() or follow_ups.cancelled():
+        return {}
+    if follow_ups.exception() is not None:
+        return {}
+    return follow_ups.result()
+
+
+def use_prefetched_answer(llm, question, future):
+    """
+    Take a prefetched answer and add the exchange to the Chat's history.
+    
+    Args:
+        llm: The lisette AsyncChat instance holding the conversation
+        question: The question the learner picked
+        future: The Future of the prefetched answer for that question
+        
+    Returns:
+        The answer text, or None if it isn't ready yet or failed; the question
+        should then be sent normally, which streams instead of making the
+        learner wait on the whole prefetched answer
+    """
+    if not future.done():
+        future.cancel()
+        return None
+    try:
+        answer = future.result()
+    except Exception:
+        return None
+    llm.hist.extend([
+        {"role": "user", "content": question},
+        {"role": "assistant", "content": answer},
+    ])
+    return answer
+
+
+def cancel_follow_ups(follow_ups):
+    """
+    Cancel follow-up requests that are no longer needed.
+    
+    Args:
+        follow_ups: The Future from start_follow_ups, or None
+    """
+    if follow_ups is None:
+        return
+    follow_ups.cancel()
+    for future in get_follow_ups(follow_ups).values():
+        future.cancel()